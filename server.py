@@ -7,14 +7,24 @@ PORT = 8000
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep-alive: a map view loads dozens of tiles over the same connection
+    protocol_version = "HTTP/1.1"
+
+    def copyfile(self, source, outputfile):
+        # Zero-copy os.sendfile() for tile files, plain send() for listings
+        self.connection.sendfile(source)
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
 
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
 if __name__ == "__main__":
-    with socketserver.TCPServer(("", PORT), MyHTTPRequestHandler) as httpd:
+    with ThreadingHTTPServer(("", PORT), MyHTTPRequestHandler) as httpd:
         print(f"Sunucu http://localhost:{PORT} adresinde çalışıyor")
         print("Tarayıcınızda http://localhost:8000/index.html adresini açın")
         print("Sunucuyu durdurmak için Ctrl+C tuşlayın")
@@ -4,7 +4,17 @@ import time
 import math
 import json
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import errno
+import threading
+import queue
+import itertools
+import sqlite3
+import functools
+from array import array
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import random
@@ -50,17 +60,47 @@ TILE_SERVERS = [
 
 # --- HELPER FUNCTIONS ---
 
+def get_enabled_servers(config):
+    """Return the tile servers enabled in config, in TILE_SERVERS order."""
+    enabled_names = frozenset(config['servers'])
+    return tuple(server for server in TILE_SERVERS if server['name'] in enabled_names)
+
 def deg2num(lat_deg, lon_deg, zoom):
     """Convert lat/lon to tile coordinates."""
     lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
+    n = 1 << zoom
     xtile = int((lon_deg + 180.0) / 360.0 * n)
     ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
     return xtile, ytile
 
+class TileList:
+    """Compact list of (zoom, x, y) tiles stored as three int32 columns.
+    
+    Iterating yields plain (zoom, x, y) tuples, one at a time.
+    """
+    
+    def __init__(self):
+        self.zooms = array('i')
+        self.xs = array('i')
+        self.ys = array('i')
+    
+    def add_grid(self, zoom, xs, ys):
+        """Append every tile of zoom in xs x ys, column by column."""
+        column = array('i', ys)
+        self.zooms.extend(array('i', [zoom]) * (len(xs) * len(column)))
+        for x in xs:
+            self.xs.extend(array('i', [x]) * len(column))
+            self.ys.extend(column)
+    
+    def __len__(self):
+        return len(self.zooms)
+    
+    def __iter__(self):
+        return zip(self.zooms, self.xs, self.ys)
+
 def get_tiles_for_bbox(bbox, min_zoom, max_zoom):
     """Get all tile coordinates for given bbox and zoom range."""
-    tiles = []
+    tiles = TileList()
     min_lon, min_lat, max_lon, max_lat = bbox
     
     print("Calculating tile coordinates...")
@@ -69,31 +109,32 @@ def get_tiles_for_bbox(bbox, min_zoom, max_zoom):
         min_x, max_y = deg2num(min_lat, min_lon, zoom)
         max_x, min_y = deg2num(max_lat, max_lon, zoom)
         
-        zoom_tiles = 0
-        for x in range(min_x, max_x + 1):
-            for y in range(min_y, max_y + 1):
-                tiles.append((zoom, x, y))
-                zoom_tiles += 1
+        xs = range(min_x, max_x + 1)
+        ys = range(min_y, max_y + 1)
+        zoom_tiles = len(xs) * len(ys)
+        tiles.add_grid(zoom, xs, ys)
         
         print(f"    Zoom {zoom}: {zoom_tiles} tiles")
     
     return tiles
 
-def create_session():
+def create_session(pool_connections=20, pool_maxsize=20):
     """Create optimized session for downloads."""
     session = requests.Session()
     
     retry_strategy = Retry(
         total=3,
         backoff_factor=1.0,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"]
+        status_forcelist=[500, 502, 504],
+        allowed_methods=["GET"],
+        # 429/503 are handled per host in download_tile_from_server
+        respect_retry_after_header=False
     )
     
     adapter = HTTPAdapter(
         max_retries=retry_strategy,
-        pool_connections=20,
-        pool_maxsize=20
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize
     )
     
     session.mount("http://", adapter)
@@ -101,57 +142,519 @@ def create_session():
     
     return session
 
+# Sessions are not fully thread-safe, so each worker thread keeps its own
+_thread_local = threading.local()
+
+def init_worker_session(pool_connections=20, pool_maxsize=20):
+    """Create the calling thread's session (ThreadPoolExecutor initializer)."""
+    _thread_local.session = create_session(pool_connections, pool_maxsize)
+
+def get_session():
+    """Return the calling thread's session, creating it on first use."""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = create_session()
+        _thread_local.session = session
+    return session
+
+# --- RATE LIMITING ---
+
+# Statuses that mean "slow down"; they pause the whole host instead of one request
+RATE_LIMIT_STATUSES = (429, 503)
+DEFAULT_RETRY_AFTER = 1.0
+MAX_RETRY_AFTER = 60.0
+
+# Host -> time.monotonic() deadline before which no request should be sent
+_host_pauses = {}
+_host_pauses_lock = threading.Lock()
+
+def parse_retry_after(value):
+    """Return the delay in seconds asked for by a Retry-After header."""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    return min(max(delay, 0.0), MAX_RETRY_AFTER)
+
+def pause_host(host, delay):
+    """Hold back every request to host for delay seconds."""
+    deadline = time.monotonic() + delay
+    with _host_pauses_lock:
+        if deadline > _host_pauses.get(host, 0.0):
+            _host_pauses[host] = deadline
+
+def host_pause_remaining(host):
+    """Return how many seconds host is still paused for (0 or less if it is not)."""
+    return _host_pauses.get(host, 0.0) - time.monotonic()
+
+def wait_for_host(host):
+    """Sleep until host is no longer paused."""
+    remaining = host_pause_remaining(host)
+    if remaining > 0:
+        time.sleep(remaining)
+
+def is_rate_limited(error):
+    """Check whether a request error is a rate-limit response."""
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in RATE_LIMIT_STATUSES
+
+# --- STORAGE FUNCTIONS ---
+
+OUTPUT_FORMATS = ('directory', 'mbtiles')
+MBTILES_BATCH_SIZE = 500
+MIN_DIRECTORY_WRITERS = 4
+# open(O_TMPFILE)/linkat errors meaning the filesystem or kernel cannot do it at all
+TMPFILE_UNSUPPORTED_ERRNOS = frozenset((errno.EOPNOTSUPP, errno.ENOTSUP, errno.EISDIR, errno.EINVAL, errno.EXDEV))
+VALIDATORS_FILE = 'tile_validators.sqlite'
+VALIDATORS_BATCH_SIZE = 500
+
+def get_output_format(config):
+    """Return the configured output format ('directory' by default)."""
+    return config.get('output_format', 'directory')
+
+def server_tile_prefix(output_dir, server_name):
+    """Return a server's tile directory with a trailing separator."""
+    return os.path.join(output_dir, server_name, '')
+
+def tile_file_path(server_prefix, zoom, x, y):
+    """Return the file path of a tile in the directory layout."""
+    return f"{server_prefix}{zoom}{os.sep}{x}{os.sep}{y}.png"
+
+def mbtiles_path(output_dir, server_name):
+    """Return the MBTiles file path of a server."""
+    return os.path.join(output_dir, f"{server_name}.mbtiles")
+
+def open_proc_fd_dir():
+    """Open /proc/self/fd for linking O_TMPFILE tiles, or None if unsupported."""
+    if not hasattr(os, 'O_TMPFILE'):
+        return None
+    try:
+        return os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return None
+
+def drop_page_cache(fd):
+    """Tell the kernel a freshly written tile will not be read back soon.
+    
+    Pages still dirty right after the write cannot be dropped yet; the hint
+    starts their writeback early and drops whatever is already clean.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+def link_tile_tmpfile(tile_path, tile_filename, content, proc_fd_dir):
+    """Write a tile into an unnamed O_TMPFILE and link it in under its final name.
+    
+    The file only becomes visible once complete. linkat() cannot replace an
+    existing file, so this raises FileExistsError for tiles already present.
+    """
+    # Same mode as open() in the fallback path, so the umask decides for both
+    fd = os.open(tile_path, os.O_TMPFILE | os.O_WRONLY, 0o666)
+    try:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view):]
+        drop_page_cache(fd)
+        # linkat() through /proc follows the fd link to the unnamed file
+        os.link(str(fd), tile_filename, src_dir_fd=proc_fd_dir)
+    finally:
+        os.close(fd)
+
+def save_tile_file(tile_filename, content, created_dirs=None, proc_fd_dir=None, replace=False):
+    """Save a tile into the directory layout.
+    
+    With proc_fd_dir (Linux) a new tile goes through an O_TMPFILE. Tiles being
+    replaced, or any tile when O_TMPFILE fails, are written to a temporary file
+    and renamed into place. Either way an interrupted run never leaves a
+    truncated .png behind. Directories already in created_dirs are not created
+    again.
+    
+    Returns False if O_TMPFILE turned out to be unsupported, so the caller can
+    stop passing proc_fd_dir.
+    """
+    tile_path = os.path.dirname(tile_filename)
+    if created_dirs is None or tile_path not in created_dirs:
+        os.makedirs(tile_path, exist_ok=True)
+        if created_dirs is not None:
+            created_dirs.add(tile_path)
+    
+    tmpfile_supported = True
+    if proc_fd_dir is not None and not replace:
+        try:
+            link_tile_tmpfile(tile_path, tile_filename, content, proc_fd_dir)
+            return True
+        except OSError as e:
+            # Anything else (e.g. the tile appeared meanwhile) falls back for this tile only
+            if e.errno in TMPFILE_UNSUPPORTED_ERRNOS:
+                tmpfile_supported = False
+    
+    tmp_filename = tile_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(content)
+        f.flush()
+        drop_page_cache(f.fileno())
+    os.replace(tmp_filename, tile_filename)
+    return tmpfile_supported
+
+def open_mbtiles(path, name):
+    """Open (creating if needed) an MBTiles database for writing."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tiles ("
+        "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, "
+        "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+    )
+    if conn.execute("SELECT 1 FROM metadata WHERE name = 'name'").fetchone() is None:
+        conn.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?)",
+            [('name', name), ('format', 'png'), ('type', 'baselayer'), ('version', '1.1')]
+        )
+    conn.commit()
+    return conn
+
+def flush_mbtiles(connections, pending, indexes=None, validator_rows=None):
+    """Insert pending tiles of every MBTiles database in one transaction each.
+    
+    Validators of committed tiles are appended to validator_rows, if given.
+    """
+    for server_name, tiles in pending.items():
+        if not tiles:
+            continue
+        conn = connections[server_name]
+        try:
+            with conn:
+                # MBTiles stores rows in TMS order (origin at the bottom)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(zoom, x, (1 << zoom) - 1 - y, sqlite3.Binary(content)) for zoom, x, y, content, _ in tiles]
+                )
+            if indexes is not None:
+                indexes[server_name].update((zoom, x, y) for zoom, x, y, _, _ in tiles)
+            if validator_rows is not None:
+                validator_rows.extend(
+                    (server_name, zoom, x, y) + validator
+                    for zoom, x, y, _, validator in tiles
+                    if validator is not None
+                )
+        except sqlite3.Error as e:
+            print(f"Write error: {server_name}.mbtiles - {e}")
+        tiles.clear()
+
+def write_tiles_mbtiles(write_queue, output_dir, indexes=None):
+    """Insert queued tiles into per-server MBTiles files in batches."""
+    connections = {}
+    pending = {}
+    validator_rows = []
+    queued = 0
+    
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        
+        server_name, (zoom, x, y), content, validator = item
+        if server_name not in connections:
+            try:
+                connections[server_name] = open_mbtiles(mbtiles_path(output_dir, server_name), server_name)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Write error: {server_name}.mbtiles - {e}")
+                connections[server_name] = None
+            pending[server_name] = []
+        
+        # Tiles of a server whose file could not be opened are dropped
+        if connections[server_name] is None:
+            continue
+        
+        pending[server_name].append((zoom, x, y, content, validator))
+        queued += 1
+        if queued >= MBTILES_BATCH_SIZE:
+            flush_mbtiles(connections, pending, indexes, validator_rows)
+            queued = 0
+            if len(validator_rows) >= VALIDATORS_BATCH_SIZE:
+                save_validators(output_dir, validator_rows)
+    
+    flush_mbtiles(connections, pending, indexes, validator_rows)
+    save_validators(output_dir, validator_rows)
+    for conn in connections.values():
+        if conn is not None:
+            conn.close()
+
+def write_tiles_directory(write_queue, output_dir, indexes=None):
+    """Save queued tiles as individual files."""
+    created_dirs = set()
+    server_prefixes = {}
+    validator_rows = []
+    proc_fd_dir = open_proc_fd_dir()
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        
+        server_name, tile_info, content, validator = item
+        zoom, x, y = tile_info
+        server_prefix = server_prefixes.get(server_name)
+        if server_prefix is None:
+            server_prefix = server_prefixes[server_name] = server_tile_prefix(output_dir, server_name)
+        tile_filename = tile_file_path(server_prefix, zoom, x, y)
+        # Indexed tiles are being replaced (revalidation), linkat() would refuse them
+        replace = indexes is not None and tile_info in indexes[server_name]
+        try:
+            if not save_tile_file(tile_filename, content, created_dirs, proc_fd_dir, replace):
+                os.close(proc_fd_dir)
+                proc_fd_dir = None
+        except OSError as e:
+            print(f"Write error: {tile_filename} - {e}")
+            continue
+        
+        if indexes is not None:
+            indexes[server_name].add(tile_info)
+        if validator is not None:
+            validator_rows.append((server_name, zoom, x, y) + validator)
+            if len(validator_rows) >= VALIDATORS_BATCH_SIZE:
+                save_validators(output_dir, validator_rows)
+    
+    save_validators(output_dir, validator_rows)
+    if proc_fd_dir is not None:
+        os.close(proc_fd_dir)
+
+def validators_path(output_dir):
+    """Return the path of the ETag/Last-Modified store of an output directory."""
+    return os.path.join(output_dir, VALIDATORS_FILE)
+
+class TileValidators:
+    """Stored (etag, last_modified) of tiles, looked up one tile at a time.
+    
+    Rows stay in SQLite instead of memory; the connection is shared by the
+    download threads, one lookup at a time.
+    """
+    
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        try:
+            self._conn.execute("SELECT 1 FROM tile_validators LIMIT 1")
+        except sqlite3.Error:
+            self._conn.close()
+            raise
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the (etag, last_modified) of a (server_name, zoom, x, y) key, or None."""
+        with self._lock:
+            try:
+                return self._conn.execute(
+                    "SELECT etag, last_modified FROM tile_validators WHERE server = ? AND zoom = ? AND x = ? AND y = ?",
+                    key
+                ).fetchone()
+            except sqlite3.Error as e:
+                # The tile is then kept as it is, like one without a validator
+                print(f"Read error: {VALIDATORS_FILE} - {e}")
+                return None
+    
+    def close(self):
+        self._conn.close()
+
+def open_validators(output_dir):
+    """Open the ETag/Last-Modified store of output_dir, or return None if there is none."""
+    path = validators_path(output_dir)
+    if not os.path.isfile(path):
+        return None
+    
+    try:
+        return TileValidators(path)
+    except sqlite3.Error as e:
+        print(f"Read error: {VALIDATORS_FILE} - {e}")
+        return None
+
+def save_validators(output_dir, rows):
+    """Store (server, zoom, x, y, etag, last_modified) rows of stored tiles and clear rows."""
+    if not rows:
+        return
+    
+    conn = None
+    try:
+        # Directory writers share the file, so wait for each other's transactions
+        conn = sqlite3.connect(validators_path(output_dir), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tile_validators ("
+                "server TEXT, zoom INTEGER, x INTEGER, y INTEGER, etag TEXT, last_modified TEXT, "
+                "PRIMARY KEY (server, zoom, x, y))"
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO tile_validators (server, zoom, x, y, etag, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+    except (OSError, sqlite3.Error) as e:
+        print(f"Write error: {VALIDATORS_FILE} - {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+        rows.clear()
+
+def get_writer_count(config):
+    """Return how many writer threads the output format can use."""
+    # SQLite allows a single writer; plain files can be written in parallel
+    if get_output_format(config) == 'mbtiles':
+        return 1
+    return max(MIN_DIRECTORY_WRITERS, os.cpu_count() or 1)
+
+def write_tiles(write_queue, config, indexes=None):
+    """Store queued (server_name, tile_info, content, validator) tiles until None is received.
+    
+    Stored tiles are added to the matching server index, if given, and their
+    (etag, last_modified) validator, if not None, to the validators file. If the writer
+    fails, the rest of the queue is drained and dropped so download workers
+    blocked on the bounded queue can still finish.
+    """
+    try:
+        if get_output_format(config) == 'mbtiles':
+            write_tiles_mbtiles(write_queue, config['output_dir'], indexes)
+        else:
+            write_tiles_directory(write_queue, config['output_dir'], indexes)
+    except Exception as e:
+        print(f"Writer error: {e}")
+        while write_queue.get() is not None:
+            pass
+
 # --- DOWNLOAD FUNCTIONS ---
 
-def download_tile_from_server(tile_info, server, output_dir, retry_attempts=3, timeout=30):
-    """Download a single tile from a specific server."""
+# Leading bytes of the image formats tile servers return (PNG, JPEG)
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff')
+
+# Pending downloads per worker thread; keeps the number of live futures bounded
+SUBMIT_WINDOW_PER_WORKER = 4
+
+def is_image_tile(content):
+    """Check that a response body is an image (PNG, JPEG or WebP) by its signature."""
+    if content.startswith(IMAGE_SIGNATURES):
+        return True
+    return content[:4] == b'RIFF' and content[8:12] == b'WEBP'
+
+def download_tile_from_server(tile_info, server, output_dir, retry_attempts=3, timeout=30, write_queue=None, existing=None,
+                              validator=None, fallback=False):
+    """Download a single tile from a specific server.
+    
+    With a stored (etag, last_modified) validator the existing tile is revalidated
+    with a conditional request instead of being skipped. The response's
+    ETag/Last-Modified are queued with the tile for the writer to store.
+    With fallback (another server can provide the tile) a paused host is given up
+    on right away instead of being waited out.
+    """
     zoom, x, y = tile_info
     tile_url = server['url'].format(z=zoom, x=x, y=y)
+    host = urlsplit(tile_url).netloc
     
-    # Create directory structure
-    tile_path = os.path.join(output_dir, server['name'], str(zoom), str(x))
-    os.makedirs(tile_path, exist_ok=True)
-    tile_filename = os.path.join(tile_path, f"{y}.png")
+    # Only needed without an index or writer thread
+    tile_filename = None
+    if existing is None or write_queue is None:
+        tile_filename = tile_file_path(server_tile_prefix(output_dir, server['name']), zoom, x, y)
 
-    # Skip if exists
-    if os.path.exists(tile_filename):
-        return f"Exists: {server['name']}/{zoom}/{x}/{y}"
+    # Skip if exists (use the pre-built index when available instead of a stat)
+    if validator is None:
+        if existing is not None:
+            if tile_info in existing:
+                return f"Exists: {server['name']}/{zoom}/{x}/{y}"
+        elif os.path.exists(tile_filename):
+            return f"Exists: {server['name']}/{zoom}/{x}/{y}"
+    
+    headers = server['headers']
+    if validator is not None:
+        etag, last_modified = validator
+        headers = dict(headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
     # Download with retry
     for attempt in range(retry_attempts):
         try:
-            if attempt > 0:
-                time.sleep(0.5 * attempt)
+            if fallback and host_pause_remaining(host) > 0:
+                return f"Rate limited: {server['name']}/{zoom}/{x}/{y}"
+            wait_for_host(host)
             
-            session = create_session()
-            response = session.get(tile_url, headers=server['headers'], timeout=timeout)
+            session = get_session()
+            response = session.get(tile_url, headers=headers, timeout=timeout)
+            if response.status_code == 304:
+                return f"Not modified: {server['name']}/{zoom}/{x}/{y}"
+            if response.status_code in RATE_LIMIT_STATUSES:
+                pause_host(host, parse_retry_after(response.headers.get('Retry-After')))
             response.raise_for_status()
+            
+            # Error pages served with 200 would otherwise be saved and never retried
+            if not is_image_tile(response.content):
+                raise ValueError(f"not an image ({response.headers.get('Content-Type', 'unknown type')})")
 
-            with open(tile_filename, 'wb') as f:
-                f.write(response.content)
+            # Hand off to the writer threads so disk I/O never holds a download slot
+            if write_queue is not None:
+                new_validator = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                if not any(new_validator):
+                    new_validator = None
+                write_queue.put((server['name'], tile_info, response.content, new_validator))
+            else:
+                save_tile_file(tile_filename, response.content)
             
+            if validator is not None:
+                return f"Updated: {server['name']}/{zoom}/{x}/{y}"
             return f"Downloaded: {server['name']}/{zoom}/{x}/{y}"
 
         except Exception as e:
             if attempt == retry_attempts - 1:
                 return f"Error: {server['name']}/{zoom}/{x}/{y} - {e}"
-            time.sleep(1.0)
+            # A rate-limited host is already paused, anything else backs off here
+            if not is_rate_limited(e):
+                time.sleep(1.0 + 0.5 * (attempt + 1))
 
-def download_tile_multi_server(tile_info, config):
-    """Download tile from multiple servers, use first successful result."""
+def download_tile_multi_server(tile_info, enabled_servers, output_dir, retry_attempts=3, timeout=30,
+                               write_queue=None, indexes=None, validators=None):
+    """Download tile from multiple servers, use first successful result.
+    
+    Tiles already saved are skipped, or revalidated against the server they came
+    from when validators holds their stored ETag/Last-Modified.
+    """
     zoom, x, y = tile_info
     
-    # Get enabled servers from config
-    enabled_servers = [s for s in TILE_SERVERS if s['name'] in config['servers']]
+    # Already saved by any server, no need to hit the network
+    if indexes is not None:
+        for server in enabled_servers:
+            if tile_info in indexes[server['name']]:
+                validator = validators.get((server['name'], zoom, x, y)) if validators is not None else None
+                if validator is None:
+                    return f"Exists: {server['name']}/{zoom}/{x}/{y}"
+                return download_tile_from_server(
+                    tile_info,
+                    server,
+                    output_dir,
+                    retry_attempts,
+                    timeout,
+                    write_queue,
+                    validator=validator
+                )
     
-    # Try each server until one succeeds
-    for server in enabled_servers:
+    # Try each server until one succeeds, only the last one waits out a paused host
+    last_server = len(enabled_servers) - 1
+    for i, server in enumerate(enabled_servers):
         result = download_tile_from_server(
             tile_info, 
             server, 
-            config['output_dir'],
-            config['retry_attempts'],
-            config['timeout']
+            output_dir,
+            retry_attempts,
+            timeout,
+            write_queue,
+            indexes.get(server['name']) if indexes is not None else None,
+            fallback=i < last_server
         )
         if "Downloaded:" in result or "Exists:" in result:
             return result
@@ -159,18 +662,122 @@ def download_tile_multi_server(tile_info, config):
     # If all servers fail, return last error
     return f"All servers failed: {zoom}/{x}/{y}"
 
-def check_existing_tiles(tiles, config):
-    """Count existing tiles across all servers."""
-    existing = 0
-    enabled_servers = [s for s in TILE_SERVERS if s['name'] in config['servers']]
+def download_tiles(tiles, config, total_workers, indexes=None, validators=None):
+    """Download all tiles on a bounded pool of worker threads."""
+    total_tiles = len(tiles)
     
-    for zoom, x, y in tiles:
-        for server in enabled_servers:
-            tile_path = os.path.join(config['output_dir'], server['name'], str(zoom), str(x), f"{y}.png")
-            if os.path.exists(tile_path):
-                existing += 1
-                break  # Found in one server, no need to check others
-    return existing
+    # Bounded so downloads pause instead of piling up tiles when the disk lags
+    write_queue = queue.Queue(maxsize=2 * total_workers)
+    writers = [
+        threading.Thread(target=write_tiles, args=(write_queue, config, indexes), daemon=True)
+        for _ in range(get_writer_count(config))
+    ]
+    for writer in writers:
+        writer.start()
+    
+    enabled_servers = get_enabled_servers(config)
+    
+    # Everything but the tile is fixed for the run, so bind it once
+    download = functools.partial(
+        download_tile_multi_server,
+        enabled_servers=enabled_servers,
+        output_dir=config['output_dir'],
+        retry_attempts=config['retry_attempts'],
+        timeout=config['timeout'],
+        write_queue=write_queue,
+        indexes=indexes,
+        validators=validators
+    )
+    
+    # One pool per host, reused by every tile the worker thread downloads
+    with ThreadPoolExecutor(
+        max_workers=total_workers,
+        initializer=init_worker_session,
+        initargs=(len(config['servers']), config['max_workers_per_server'] * 2)
+    ) as executor:
+        tiles_iter = iter(tiles)
+        inflight = {
+            executor.submit(download, tile)
+            for tile in itertools.islice(tiles_iter, total_workers * SUBMIT_WINDOW_PER_WORKER)
+        }
+        
+        completed = 0
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                completed += 1
+                result = future.result()
+                
+                # Progress update every 100 tiles
+                if completed % 100 == 0 or completed == total_tiles:
+                    progress = (completed / total_tiles) * 100
+                    print(f"Progress: {completed}/{total_tiles} ({progress:.1f}%) - {result}")
+            
+            # Top the window back up with the next tiles
+            for tile in itertools.islice(tiles_iter, len(done)):
+                inflight.add(executor.submit(download, tile))
+    
+    # Flush pending writes before the caller inspects the output directory
+    for _ in writers:
+        write_queue.put(None)
+    for writer in writers:
+        writer.join()
+
+def index_server_tiles(server_dir):
+    """Collect (zoom, x, y) of every tile saved under a server directory."""
+    tiles = set()
+    if not os.path.isdir(server_dir):
+        return tiles
+    
+    with os.scandir(server_dir) as zoom_entries:
+        for zoom_entry in zoom_entries:
+            if not (zoom_entry.is_dir() and zoom_entry.name.isdigit()):
+                continue
+            zoom = int(zoom_entry.name)
+            with os.scandir(zoom_entry.path) as x_entries:
+                for x_entry in x_entries:
+                    if not (x_entry.is_dir() and x_entry.name.isdigit()):
+                        continue
+                    x = int(x_entry.name)
+                    with os.scandir(x_entry.path) as y_entries:
+                        for y_entry in y_entries:
+                            name = y_entry.name
+                            if name.endswith('.png') and name[:-4].isdigit():
+                                tiles.add((zoom, x, int(name[:-4])))
+    return tiles
+
+def index_mbtiles_tiles(path):
+    """Collect (zoom, x, y) of every tile stored in an MBTiles file."""
+    if not os.path.isfile(path):
+        return set()
+    
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            (zoom, x, (1 << zoom) - 1 - row)
+            for zoom, x, row in conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles")
+        }
+    finally:
+        conn.close()
+
+def index_existing_tiles(config):
+    """Index existing tiles of every enabled server with one walk (or query) each."""
+    output_dir = config['output_dir']
+    if get_output_format(config) == 'mbtiles':
+        return {
+            server['name']: index_mbtiles_tiles(mbtiles_path(output_dir, server['name']))
+            for server in get_enabled_servers(config)
+        }
+    return {
+        server['name']: index_server_tiles(os.path.join(output_dir, server['name']))
+        for server in get_enabled_servers(config)
+    }
+
+def check_existing_tiles(tiles, indexes):
+    """Count existing tiles across all servers."""
+    server_indexes = list(indexes.values())
+    # Found in one server, no need to check others
+    return sum(1 for tile in tiles if any(tile in index for index in server_indexes))
 
 # --- MAIN FUNCTION ---
 
@@ -181,6 +788,11 @@ def download_region(region_name, config):
         print(f"Available regions: {list(config['regions'].keys())}")
         return False
     
+    if get_output_format(config) not in OUTPUT_FORMATS:
+        print(f"Unknown output format '{get_output_format(config)}' in config!")
+        print(f"Available formats: {list(OUTPUT_FORMATS)}")
+        return False
+    
     region = config['regions'][region_name]
     bbox = region['bbox']
     min_zoom = region['min_zoom']
@@ -190,7 +802,9 @@ def download_region(region_name, config):
     print(f"Bounding Box: {bbox}")
     print(f"Zoom Levels: {min_zoom} to {max_zoom}")
     print(f"Output Directory: {config['output_dir']}")
+    print(f"Output Format: {get_output_format(config)}")
     print(f"Enabled Servers: {config['servers']}")
+    print(f"Revalidate Existing Tiles: {bool(config.get('revalidate', False))}")
     print()
     
     # Get all tiles to download
@@ -201,7 +815,8 @@ def download_region(region_name, config):
     print(f"Total tiles to download: {total_tiles}")
     
     # Check existing tiles
-    existing = check_existing_tiles(all_tiles, config)
+    indexes = index_existing_tiles(config)
+    existing = check_existing_tiles(all_tiles, indexes)
     print(f"Existing tiles: {existing}")
     print(f"Remaining to download: {total_tiles - existing}")
     print()
@@ -219,37 +834,27 @@ def download_region(region_name, config):
     print("Starting multi-server download...")
     print("=" * 50)
     
-    with ThreadPoolExecutor(max_workers=total_workers) as executor:
-        futures = [executor.submit(download_tile_multi_server, tile, config) for tile in all_tiles]
-        
-        completed = 0
-        for future in as_completed(futures):
-            completed += 1
-            result = future.result()
-            
-            # Progress update every 100 tiles
-            if completed % 100 == 0 or completed == total_tiles:
-                progress = (completed / total_tiles) * 100
-                print(f"Progress: {completed}/{total_tiles} ({progress:.1f}%) - {result}")
+    # Stored ETag/Last-Modified of earlier runs, for conditional requests
+    validators = open_validators(config['output_dir']) if config.get('revalidate', False) else None
+    try:
+        download_tiles(all_tiles, config, total_workers, indexes, validators)
+    finally:
+        if validators is not None:
+            validators.close()
     
     print("=" * 50)
     print("Multi-server download completed!")
     print(f"Tiles saved to: {config['output_dir']}")
     
-    # Final check
-    final_existing = check_existing_tiles(all_tiles, config)
+    # Final check (the writer kept the indexes up to date, no rescan needed)
+    final_existing = check_existing_tiles(all_tiles, indexes)
     print(f"Successfully downloaded: {final_existing}/{total_tiles} tiles")
     
     # Show results by server
     print("\nResults by server:")
-    for server in TILE_SERVERS:
-        if server['name'] in config['servers']:
-            server_tiles = 0
-            for zoom, x, y in all_tiles:
-                tile_path = os.path.join(config['output_dir'], server['name'], str(zoom), str(x), f"{y}.png")
-                if os.path.exists(tile_path):
-                    server_tiles += 1
-            print(f"  {server['name']}: {server_tiles} tiles")
+    for server_name, index in indexes.items():
+        server_tiles = sum(1 for tile in all_tiles if tile in index)
+        print(f"  {server_name}: {server_tiles} tiles")
     
     return True
 